@@ -1,6 +1,5 @@
 from __future__ import division, unicode_literals, print_function
 
-import copy
 import datetime
 import logging
 import sys
@@ -12,12 +11,70 @@ from django.utils import timezone
 from imapclient import IMAPClient  # noqa: F401 ignore unused we use it for typing
 
 from engine.models.calendar import MyCalendar
+from engine.models.event import Event  # noqa: F401 ignore unused we use it for typing
 from engine.models.mailbox import MailBox  # noqa: F401 ignore unused we use it for typing
-from engine.models.message import Message
-from schema.youps import MailbotMode, MessageSchema, TaskManager  # noqa: F401 ignore unused we use it for typing
+from engine.models.message import Message, close_smtp_connections
+from schema.youps import EmailRule, MailbotMode, MessageSchema, TaskManager  # noqa: F401 ignore unused we use it for typing
 import sandbox_helpers
 logger = logging.getLogger('youps')  # type: logging.Logger
 
+def _get_user_std_out():
+    # type: () -> StringIO
+    """Get an empty buffer to capture the user's output
+
+    A new buffer is made for every call. A py2 StringIO which was written
+    both unicode and non-ascii byte strings can no longer be read or reset,
+    so sharing one between calls would break every later run on the thread.
+
+    Returns:
+        StringIO: empty string buffer
+    """
+    return StringIO()
+
+
+def _flush_user_std_out(user_std_out):
+    # type: (StringIO) -> t.Tuple[t.Optional[t.AnyStr], StringIO]
+    """Read and empty the buffer capturing the user's output
+
+    If the user's code wrote both unicode and non-ascii byte strings the buffer
+    can't be read or reset anymore, so it is replaced by a fresh one which
+    sys.stdout is pointed at.
+
+    Args:
+        user_std_out (StringIO): buffer sys.stdout currently writes to
+
+    Returns:
+        t.Tuple[t.Optional[t.AnyStr], StringIO]: the output, or None if it could not
+            be decoded, and the buffer to keep writing to
+    """
+    try:
+        log_text = user_std_out.getvalue()
+        user_std_out.seek(0)
+        user_std_out.truncate()
+        return log_text, user_std_out
+    except UnicodeDecodeError:
+        user_std_out = _get_user_std_out()
+        sys.stdout = user_std_out
+        return None, user_std_out
+
+
+def _recording_handle(event, used_events):
+    # type: (Event, t.Set[Event]) -> t.Callable[[t.Callable], Event]
+    """Wrap event.handle so registering a function also records the event
+
+    Args:
+        event (Event): the event user code registers functions with
+        used_events (t.Set[Event]): set the event is added to when it is used
+
+    Returns:
+        t.Callable[[t.Callable], Event]: replacement for event.handle
+    """
+    def handle(handler):
+        used_events.add(event)
+        return event.handle(handler)
+    return handle
+
+
 def interpret_bypass_queue(mailbox, mode, extra_info):
     # type: (MailBox, MailbotMode, t.Dict[t.AnyStr, t.Any]) -> None
 
@@ -26,60 +83,102 @@ def interpret_bypass_queue(mailbox, mode, extra_info):
     # set up the default result
     res = {'status': True, 'imap_error': False, 'imap_log': "", 'appended_log': {}}
 
-    # create a string buffer to store stdout
-    user_std_out = StringIO()
-    with sandbox_helpers.override_print(user_std_out) as fakeprint:
-        code = extra_info['code']
-        message_schemas = MessageSchema.objects.filter(id=extra_info['msg-id'])
+    # create a list of strings to store stdout
+    user_std_out = []
+    try:
+        with sandbox_helpers.override_print(user_std_out) as fakeprint:
+            code = extra_info['code']
+            # the folder and base message are read for every message so join them in
+            message_schemas = MessageSchema.objects.filter(id=extra_info['msg-id']).select_related(*Message._schema_select_related)
 
-        # define the variables accessible to the user
-        user_environ = sandbox_helpers.get_default_user_environment(mailbox, fakeprint)
+            # define the variables accessible to the user
+            user_environ = sandbox_helpers.get_default_user_environment(mailbox, fakeprint)
 
-        # Applying diff msgs to a same source code
-        # TODO this code is completely broken and fires events based on function names
-        for message_schema in message_schemas:
-            msg_log = {"log": "", "error": False}
+            # Applying diff msgs to a same source code
+            # TODO this code is completely broken and fires events based on function names
+            for message_schema in message_schemas:
+                msg_log = {"log": "", "error": False}
 
-            try:
-                # create a read-only message object to prevent changing the message
-                new_message = Message(message_schema, mailbox._imap_client, is_simulate=mailbox.is_simulate)
-                user_environ['new_message'] = new_message
-                mailbox._imap_client.select_folder(message_schema.folder.name)
-
-                # execute the user's code
-                if "on_message" in code:
-                    exec(code + "\non_message(new_message)", user_environ)    
-
-                elif "on_flag_change" in code:
-                    user_environ['new_flag'] = 'test-flag'
-                    exec(code + "\non_flag_change(new_message, new_flag)", user_environ)    
-
-                elif "on_command" in code:
-                    user_environ['content'] = extra_info['shortcut']
-                    exec(code + "\non_command(new_message, content)", user_environ)
-
-                elif "on_deadline" in code:
-                    exec(code + "\non_deadline(new_message)", user_environ)    
-
-            except Exception:
-                # Get error message for users if occurs
-                # print out error messages for user
-                logger.exception("failure simulating user %s code" % mailbox._imap_account.email)
-                msg_log["error"] = True
-                fakeprint(sandbox_helpers.get_error_as_string_for_user())
-            finally:
-                msg_log["log"] += user_std_out.getvalue()
-                # msg_log["log"] = "%s\n%s" % (user_std_out.getvalue(), msg_log["log"])
-                res['appended_log'][message_schema.id] = msg_log
+                try:
+                    # create a read-only message object to prevent changing the message
+                    new_message = Message(message_schema, mailbox._imap_client, is_simulate=mailbox.is_simulate)
+                    # copy the environment so nothing leaks between messages
+                    msg_environ = dict(user_environ, new_message=new_message)
+                    mailbox._imap_client.select_folder(message_schema.folder.name)
 
-                # clear current input buffer
-                user_std_out.truncate(0)
+                    # execute the user's code
+                    if "on_message" in code:
+                        exec(sandbox_helpers.compile_user_code(code + "\non_message(new_message)"), msg_environ)    
+
+                    elif "on_flag_change" in code:
+                        msg_environ['new_flag'] = 'test-flag'
+                        exec(sandbox_helpers.compile_user_code(code + "\non_flag_change(new_message, new_flag)"), msg_environ)    
+
+                    elif "on_command" in code:
+                        msg_environ['content'] = extra_info['shortcut']
+                        exec(sandbox_helpers.compile_user_code(code + "\non_command(new_message, content)"), msg_environ)
+
+                    elif "on_deadline" in code:
+                        exec(sandbox_helpers.compile_user_code(code + "\non_deadline(new_message)"), msg_environ)    
+
+                except Exception:
+                    # Get error message for users if occurs
+                    # print out error messages for user
+                    logger.exception("failure simulating user %s code" % mailbox._imap_account.email)
+                    msg_log["error"] = True
+                    fakeprint(sandbox_helpers.get_error_as_string_for_user())
+                finally:
+                    msg_log["log"] += ''.join(user_std_out)
+                    # msg_log["log"] = "%s\n%s" % (user_std_out.getvalue(), msg_log["log"])
+                    res['appended_log'][message_schema.id] = msg_log
+
+                    # clear current input buffer
+                    del user_std_out[:]
+    finally:
+        # replies sent during this run reused one connection per account, close them
+        close_smtp_connections()
 
     return res
 
 
 
 
+def _get_rule_dispatch(rule, mailbox):
+    # type: (EmailRule, MailBox) -> t.Tuple[t.AnyStr, t.Dict[t.AnyStr, Event]]
+    """Work out how a rule is run and which events it handles
+
+    Basically at the end of the user's code we need to attach the user's code
+    to the event. User code strings can be found at
+    http_handler/static/javascript/youps/login_imap.js ~ line 300
+    our handlers are in mailbox and the user environment.
+
+    Args:
+        rule (EmailRule): the rule to run
+        mailbox (MailBox): user's mailbox
+
+    Returns:
+        t.Tuple[t.AnyStr, t.Dict[t.AnyStr, Event]]: the code to exec for the rule and
+            a map from the event data class names the rule handles to the handler to fire
+    """
+    code = rule.code or ""
+    fires = {}  # type: t.Dict[t.AnyStr, Event]
+    if rule.type.startswith("new-message"):
+        code = code + "\nhandle_on_message(on_message)"
+        if rule.type == "new-message":
+            fires["MessageArrivalData"] = mailbox.new_message_handler
+        elif rule.type.startswith("new-message-"):
+            fires["NewMessageDataScheduled"] = mailbox.new_message_handler
+    elif rule.type == "flag-change":
+        code = code + "\nhandle_on_flag_added(on_flag_added)"
+        code = code + "\nhandle_on_flag_removed(on_flag_removed)"
+        fires["NewFlagsData"] = mailbox.added_flag_handler
+        fires["RemovedFlagsData"] = mailbox.removed_flag_handler
+    elif rule.type.startswith("deadline"):
+        code = code + "\nhandle_on_deadline(on_deadline)"
+        fires["NewMessageDataDue"] = mailbox.deadline_handler
+    return code, fires
+
+
 def interpret(mailbox, mode):
     """This function executes users' code.  
 
@@ -92,8 +191,6 @@ def interpret(mailbox, mode):
     """
     # type: (MailBox, MailbotMode, bool) -> t.Dict[t.AnyStr, t.Any]
 
-    from schema.youps import EmailRule, MailbotMode
-
     # set up the default result
     res = {'status': True, 'imap_error': False, 'imap_log': ""}
 
@@ -103,21 +200,38 @@ def interpret(mailbox, mode):
     # assert isinstance(mode, MailbotMode)
     assert mailbox.new_message_handler is not None
 
-    def on_message_arrival(func):
-        mailbox.new_message_handler += func
-
-
     # get the logger for user output
     userLogger = logging.getLogger('youps.user')  # type: logging.Logger
     # get the stream handler associated with the user output
-    userLoggerStreamHandlers = filter(lambda h: isinstance(h, logging.StreamHandler), userLogger.handlers)
-    userLoggerStream = userLoggerStreamHandlers[0].stream if userLoggerStreamHandlers else None
+    userLoggerStreamHandler = next((h for h in userLogger.handlers if isinstance(h, logging.StreamHandler)), None)
+    userLoggerStream = userLoggerStreamHandler.stream if userLoggerStreamHandler else None
     assert userLoggerStream is not None
 
     # create a string buffer to store stdout
-    user_std_out = StringIO()
-
-    new_log = {}
+    user_std_out = _get_user_std_out()
+
+    # log entries for the user in the order they were created
+    new_log = []  # type: t.List[t.Dict[t.AnyStr, t.Any]]
+
+    # the events the current rule's code registered functions with
+    used_events = set()  # type: t.Set[Event]
+
+    # define the variables accessible to the user
+    # this is never passed to exec directly, each exec gets its own copy so
+    # names defined by one rule do not leak into the next
+    user_environ = {
+        'create_draft': mailbox.create_draft,
+        'create_folder': mailbox.create_folder,
+        'get_email_mode': mailbox.get_email_mode,
+        'set_email_mode': mailbox.set_email_mode,
+        'send': mailbox.send,
+        'handle_on_message': _recording_handle(mailbox.new_message_handler, used_events),
+        'handle_on_flag_added': _recording_handle(mailbox.added_flag_handler, used_events),
+        'handle_on_flag_removed': _recording_handle(mailbox.removed_flag_handler, used_events),
+        'handle_on_deadline': _recording_handle(mailbox.deadline_handler, used_events),
+        'Calendar': MyCalendar,
+
+    }
 
     # execute user code
     try:
@@ -127,38 +241,41 @@ def interpret(mailbox, mode):
         # set the user logger to
         userLoggerStream = user_std_out
 
-        from schema.youps import FolderSchema
-
-        # define the variables accessible to the user
-        user_environ = {
-            'create_draft': mailbox.create_draft,
-            'create_folder': mailbox.create_folder,
-            'get_email_mode': mailbox.get_email_mode,
-            'set_email_mode': mailbox.set_email_mode,
-            'send': mailbox.send,
-            'handle_on_message': lambda f: mailbox.new_message_handler.handle(f),
-            'handle_on_flag_added': lambda f: mailbox.added_flag_handler.handle(f),
-            'handle_on_flag_removed': lambda f: mailbox.removed_flag_handler.handle(f),
-            'handle_on_deadline': lambda f: mailbox.deadline_handler.handle(f),
-            'Calendar': MyCalendar,
+        # load the rules for the current mode and the folders they apply to once
+        # rather than once per event, and not at all when there are no events
+        rules = []  # type: t.List[EmailRule]
+        if mode is not None and mailbox.event_data_list:
+            rules = list(EmailRule.objects.filter(mode=mode).prefetch_related('folders'))
+        valid_folders_map = {
+            rule.id: {f.id for f in rule.folders.all() if f.imap_account_id == mailbox._imap_account.id}
+            for rule in rules
+        }  # type: t.Dict[int, t.Set[int]]
+        rule_dispatch = {rule.id: _get_rule_dispatch(rule, mailbox) for rule in rules}
 
-        }
+        # map from message schema id to the friendly from, to and cc fields
+        contact_fields_cache = {}  # type: t.Dict[int, t.Tuple[t.Dict, t.List[t.Dict], t.List[t.Dict]]]
 
         # iterate through event queue
         for event_data in mailbox.event_data_list:
+            event_class_name = type(event_data).__name__
+            folder_id = event_data.message._schema.folder_id
             new_msg = {}
 
             # event for new message arrival
             # TODO maybe caputre this info after execute log?
             if True:
                 # This is to log for users
-                from_field = event_data.message._get_from_friendly()
-
-                to_field = event_data.message._get_to_friendly()
-
-                cc_field = event_data.message._get_cc_friendly()
-
-                new_msg["timestamp"] = str(datetime.datetime.now().strftime("%m/%d %H:%M:%S,%f"))
+                # the same message can show up in several events (i.e. new message and new flags)
+                # so only look up its contacts once
+                contact_fields = contact_fields_cache.get(event_data.message._schema.id)
+                if contact_fields is None:
+                    contact_fields = (event_data.message._get_from_friendly(),
+                                      event_data.message._get_to_friendly(),
+                                      event_data.message._get_cc_friendly())
+                    contact_fields_cache[event_data.message._schema.id] = contact_fields
+                from_field, to_field, cc_field = contact_fields
+
+                new_msg["timestamp"] = datetime.datetime.now().strftime("%m/%d %H:%M:%S,%f")
                 new_msg["type"] = "new_message"
                 new_msg["from_"] = from_field
                 new_msg["to"] = to_field
@@ -170,67 +287,35 @@ def interpret(mailbox, mode):
             if mode is None:
                 new_msg.update(event_data.message._get_meta_data_friendly())
                 # logger.info(new_msg)
-                new_log[new_msg["timestamp"]] = new_msg
+                new_log.append(new_msg)
 
                 continue
 
             # Iterate through email rule at the current mode
-            # TODO maybe use this instead of mode.rules
-            for rule in EmailRule.objects.filter(mode=mode):
+            for rule_index, rule in enumerate(rules):
                 is_fired = False
-                copy_msg = copy.deepcopy(new_msg)
-                copy_msg["timestamp"] = str(datetime.datetime.now().strftime("%m/%d %H:%M:%S,%f"))
+                copy_msg = new_msg.copy()
+                # the timestamp is used as the log key so it has to be unique per rule.
+                # append the rule index to the microseconds rather than calling now() again
+                copy_msg["timestamp"] = "%s%03d" % (new_msg["timestamp"], rule_index)
 
                 assert isinstance(rule, EmailRule)
 
-                # TODO why the reassignment of valid folders
-                valid_folders = rule.folders.all()
-                valid_folders = FolderSchema.objects.filter(imap_account=mailbox._imap_account, rules=rule)
-                code = rule.code
-
-                logger.debug(code)
-
-                # add the user's functions to the event handlers
-                # basically at the end of the user's code we need to attach the user's code to
-                # the event
-                # user code strings can be found at http_handler/static/javascript/youps/login_imap.js ~ line 300
-                # our handlers are in mailbox and the user environment
-                if rule.type.startswith("new-message"):
-                    code = code + "\nhandle_on_message(on_message)"
-                elif rule.type == "flag-change":
-                    code = code + "\nhandle_on_flag_added(on_flag_added)"
-                    code = code + "\nhandle_on_flag_removed(on_flag_removed)"
-                elif rule.type.startswith("deadline"):
-                    code = code + "\nhandle_on_deadline(on_deadline)"
-                # else:
-                #     continue
-                #     # some_handler or something += repeat_every
+                code, fires = rule_dispatch[rule.id]
 
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(code)
 
                 try:
                     # execute the user's code
                     # exec cant register new function (e.g., on_message_arrival) when there is a user_env
-                    exec(code, user_environ)
+                    exec(sandbox_helpers.compile_user_code(code), user_environ.copy())
 
-
-                    # TODO this should be cleaned up. accessing class name is ugly and this is very wet (Not DRY)
-                    if event_data.message._schema.folder in valid_folders:
-                        event_class_name = type(event_data).__name__
-                        if (event_class_name == "MessageArrivalData" and rule.type =="new-message") or \
-                                (event_class_name == "NewMessageDataScheduled" and rule.type.startswith("new-message-")):
-                            event_data.fire_event(mailbox.new_message_handler)
-                            is_fired = True
-                        if (event_class_name == "NewFlagsData" and rule.type == "flag-change"):
-                            event_data.fire_event(mailbox.added_flag_handler)
+                    if folder_id in valid_folders_map[rule.id]:
+                        handler = fires.get(event_class_name)
+                        if handler is not None:
+                            event_data.fire_event(handler)
                             is_fired = True
-                        if (event_class_name == "RemovedFlagsData" and rule.type == "flag-change"):
-                            event_data.fire_event(mailbox.removed_flag_handler)
-                            is_fired = True
-                        if (event_class_name == "NewMessageDataDue" and rule.type.startswith("deadline")):
-                            event_data.fire_event(mailbox.deadline_handler)
-                            is_fired = True
-
-                        if is_fired:
                             logger.info("firing %s %s" % (rule.name, event_data.message.subject))
 
                 except Exception as e:
@@ -242,37 +327,42 @@ def interpret(mailbox, mode):
 
                     exc_type, exc_obj, exc_tb = sys.exc_info()
                     logger.exception("failure running user %s code" % mailbox._imap_account.email)
-                    copy_msg["log"] = str(e) + traceback.format_tb(exc_tb)[-1]
+                    copy_msg["log"] = str(e) + sandbox_helpers.get_last_frame_as_string(exc_tb)
                     copy_msg["error"] = True
                 finally:
-                    if is_fired:
+                    # read and flush the buffer, reusing it for the next rule
+                    log_text, user_std_out = _flush_user_std_out(user_std_out)
+                    # always report unreadable output so the user knows the rule's log was lost
+                    is_output_lost = log_text is None
+                    if is_output_lost:
+                        logger.error("could not decode output of user %s rule %s" % (mailbox._imap_account.email, rule.name))
+                        copy_msg["error"] = True
+                        log_text = "Your output could not be read, don't print unicode and non-ascii byte strings together"
+
+                    if is_fired or is_output_lost:
                         copy_msg.update(event_data.message._get_meta_data_friendly())
-                        logger.info("handling fired %s %s" % (rule.name, event_data.message.subject))
+                        if is_fired:
+                            logger.info("handling fired %s %s" % (rule.name, event_data.message.subject))
                         copy_msg["trigger"] = rule.name or (rule.type.replace("_", " ") + " untitled")
 
-                        copy_msg["log"] = "%s\n%s" % (user_std_out.getvalue(), copy_msg["log"] if "log" in copy_msg else "")
-
-                        new_log[copy_msg["timestamp"]] = copy_msg
-
-                    # flush buffer
-                    user_std_out = StringIO()
+                        copy_msg["log"] = "\n".join((log_text, copy_msg.get("log", "")))
 
-                    # set the stdout to a string
-                    sys.stdout = user_std_out
+                        new_log.append(copy_msg)
 
-                    # set the user logger to
-                    userLoggerStream = user_std_out
-
-                mailbox.new_message_handler.removeAllHandles()
-                mailbox.added_flag_handler.removeAllHandles()
+                # reset only the handlers the rule's code registered with
+                for handler in used_events:
+                    handler.removeAllHandles()
+                used_events.clear()
 
         # Task manager
-        for task in TaskManager.objects.filter(imap_account=mailbox._imap_account):
-            now = timezone.now().replace(microsecond=0)
+        # only fetch the tasks which are due
+        now = timezone.now().replace(microsecond=0)
+        due_tasks = TaskManager.objects.filter(imap_account=mailbox._imap_account, date__lte=now).select_related('email_rule')
+        logger.debug("%d tasks due at %s", len(due_tasks), now)
+        # ids of the tasks which ran (or failed) and are deleted together at the end
+        fired_task_ids = []  # type: t.List[int]
+        for task in due_tasks:
             is_fired = False
-            logger.critical("%s %s" % (task.date, now))
-            if task.date > now:
-                continue
 
             new_msg = {}
             # from_field = event_data.message._get_from_friendly()
@@ -284,21 +374,19 @@ def interpret(mailbox, mode):
             # # This is to log for users
             # new_msg = event_data.message._get_meta_data_friendly()
 
-            new_msg["timestamp"] = str(datetime.datetime.now().strftime("%m/%d %H:%M:%S,%f"))
+            new_msg["timestamp"] = datetime.datetime.now().strftime("%m/%d %H:%M:%S,%f")
             new_msg["type"] = "see-later"
             # new_msg["from_"] = from_field
             # new_msg["to"] = to_field
             # new_msg["cc"] = cc_field
 
-            copy_msg = copy.deepcopy(new_msg)
-            copy_msg["timestamp"] = str(datetime.datetime.now().strftime("%m/%d %H:%M:%S,%f"))
+            copy_msg = new_msg.copy()
 
             try:
-                user_environ['imap'] = mailbox._imap_client
-        
                 code = task.email_rule.code
-                logger.critical("%s %s %s" % (task.date, now, code))
-                exec(code, user_environ)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("%s %s %s" % (task.date, now, code))
+                exec(sandbox_helpers.compile_user_code(code), dict(user_environ, imap=mailbox._imap_client))
                 is_fired = True
             except Exception as e:
                 logger.critical("Error during task managing %s " % e)
@@ -312,25 +400,29 @@ def interpret(mailbox, mode):
                 logger.info(traceback.format_tb(exc_tb))
                 logger.info(sys.exc_info())
                 
-                copy_msg["log"] = str(e) + traceback.format_tb(exc_tb)[-1]
-                task.delete()
+                copy_msg["log"] = str(e) + sandbox_helpers.get_last_frame_as_string(exc_tb)
+                fired_task_ids.append(task.id)
             finally:
                 if is_fired:
                     copy_msg["trigger"] = task.email_rule.name
-                    task.delete()
+                    fired_task_ids.append(task.id)
                         
                     # copy_msg["log"] = "%s\n%s" % (user_std_out.getvalue(), copy_msg["log"] )
 
-                    # new_log[copy_msg["timestamp"]] = copy_msg    
+                    # new_log.append(copy_msg)    
 
                 # flush buffer
-                user_std_out = StringIO()
+                log_text, user_std_out = _flush_user_std_out(user_std_out)
+                if log_text is None:
+                    logger.error("could not decode output of user %s task %d" % (mailbox._imap_account.email, task.id))
 
-                # set the stdout to a string
-                sys.stdout = user_std_out
+                # the task's code can register handlers too, don't let them outlive it
+                for handler in used_events:
+                    handler.removeAllHandles()
+                used_events.clear()
 
-                # set the user logger to
-                userLoggerStream = user_std_out                
+        if fired_task_ids:
+            TaskManager.objects.filter(id__in=fired_task_ids).delete()
 
     except Exception as e:
         res['status'] = False
@@ -340,6 +432,9 @@ def interpret(mailbox, mode):
         sys.stdout = sys.__stdout__
         userLoggerStream = sys.__stdout__
 
+        # replies sent during this run reused one connection per account, close them
+        close_smtp_connections()
+
         # if it is simulate don't save to db
         if mailbox.is_simulate:
             logger.debug(res)
@@ -349,5 +444,4 @@ def interpret(mailbox, mode):
             # logger.info(new_log)
             res['imap_log'] = new_log
 
-        user_std_out.close()
         return res
@@ -1,5 +1,6 @@
 # coding: utf-8
 from __future__ import print_function
+import __future__
 from contextlib import contextmanager
 import __builtin__
 import typing as t
@@ -7,10 +8,21 @@ from engine.models.calendar import MyCalendar
 import traceback
 import logging 
 if t.TYPE_CHECKING:
+    import types  # noqa: F401 ignore unused we use it for typing
     from engine.models.mailbox import Mailbox  # noqa: F401 ignore unused we use it for typing
 
 logger = logging.getLogger('youps')  # type: logging.Logger
 
+# exec in browser/sandbox.py runs user code with that module's future imports
+# so compile user code with the same ones
+_USER_CODE_FLAGS = (__future__.division.compiler_flag |
+                    __future__.print_function.compiler_flag |
+                    __future__.unicode_literals.compiler_flag)
+# maximum number of compiled user code objects kept in memory
+_CODE_CACHE_SIZE = 256
+# map from user source code to the compiled code object
+_code_cache = {}  # type: t.Dict[t.AnyStr, t.Any]
+
 
 def get_error_as_string_for_user():
     # type: () -> t.AnyStr
@@ -24,6 +36,48 @@ def get_error_as_string_for_user():
     error_messages = traceback.format_exc().splitlines()
     return error_messages[-1]
 
+def get_last_frame_as_string(tb):
+    # type: (types.TracebackType) -> t.AnyStr
+    """Format only the innermost frame of a traceback
+
+    Same as traceback.format_tb(tb)[-1] without formatting every other frame
+
+    Args:
+        tb (types.TracebackType): traceback, i.e. the third item of sys.exc_info()
+
+    Returns:
+        t.AnyStr: the formatted innermost frame
+    """
+    while tb.tb_next is not None:
+        tb = tb.tb_next
+    return traceback.format_list(traceback.extract_tb(tb, 1))[0]
+
+def compile_user_code(code):
+    # type: (t.AnyStr) -> t.Any
+    """Compile the user's code, reusing the code object if the same source was
+    compiled before
+
+    The filename is kept as <string> so tracebacks shown to the user look the
+    same as when the source is passed to exec directly.
+
+    Args:
+        code (t.AnyStr): python source code to compile
+
+    Raises:
+        SyntaxError: if the user's code is not valid python
+
+    Returns:
+        code: code object which can be passed to exec
+    """
+    code_obj = _code_cache.get(code)
+    if code_obj is None:
+        if len(_code_cache) >= _CODE_CACHE_SIZE:
+            _code_cache.clear()
+        code_obj = compile(code, '<string>', 'exec', _USER_CODE_FLAGS, True)
+        _code_cache[code] = code_obj
+    return code_obj
+
+
 def get_default_user_environment(mailbox, fakeprint):
     return {
         'create_draft': mailbox.create_draft,
@@ -31,10 +85,10 @@ def get_default_user_environment(mailbox, fakeprint):
         'get_email_mode': mailbox.get_email_mode,
         'set_email_mode': mailbox.set_email_mode,
         'send': mailbox.send,
-        'handle_on_message': lambda f: mailbox.new_message_handler.handle(f),
-        'handle_on_flag_added': lambda f: mailbox.added_flag_handler.handle(f),
-        'handle_on_flag_removed': lambda f: mailbox.removed_flag_handler.handle(f),
-        'handle_on_deadline': lambda f: mailbox.deadline_handler.handle(f),
+        'handle_on_message': mailbox.new_message_handler.handle,
+        'handle_on_flag_added': mailbox.added_flag_handler.handle,
+        'handle_on_flag_removed': mailbox.removed_flag_handler.handle,
+        'handle_on_deadline': mailbox.deadline_handler.handle,
         'Calendar': MyCalendar,
         'print': fakeprint
     }
@@ -42,29 +96,38 @@ def get_default_user_environment(mailbox, fakeprint):
 
 @contextmanager
 def override_print(output):
-    #  type: (t.TextIO) -> t.Generator[None, None, None]
-    """Safely create a new version of print that prints to the passed in output
+    #  type: (t.List[t.AnyStr]) -> t.Generator[None, None, None]
+    """Safely create a new version of print that appends to the passed in list
 
     If this isn't working make sure that from __future__ import print_function
     is at the top of every file that you are printing in
 
     Usage:
-        output = StringIO() 
+        output = []
         with override_print(output):
-            print("this will go to StringIO")
-    
+            print("this will go to output")
+        ''.join(output)
+
     Args:
-        output (t.TextIO): Object that can be written to like a file
-    
+        output (t.List[t.AnyStr]): list that printed strings are appended to
+
     Returns:
         t.Generator[None, None, None]: should be used in a with statement
     """
     original_print = __builtin__.print
 
     def fake_print(*args, **kwargs):
-        if 'file' not in kwargs:
-            kwargs['file'] = output
-        return original_print(*args, **kwargs)
+        # printing to an explicit file still goes through the real print
+        if kwargs.get('file') is not None:
+            return original_print(*args, **kwargs)
+        # None is valid for sep and end and means use the default
+        sep = kwargs.get('sep')
+        if sep is None:
+            sep = ' '
+        end = kwargs.get('end')
+        if end is None:
+            end = '\n'
+        output.append(sep.join(a if isinstance(a, basestring) else str(a) for a in args) + end)
     # __builtin__.print = fake_print
     try:
         yield fake_print
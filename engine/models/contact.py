@@ -92,7 +92,7 @@ class Contact(object):
             t.List[Message]: The messages where this contact is listed in the to field
         """
         from engine.models.message import Message
-        return [Message(message_schema, self._imap_client) for message_schema in self._schema.to_messages.all()]
+        return Message.from_queryset(MessageSchema.objects.filter(base_message__to=self._schema), self._imap_client)
 
     @property
     def messages_from(self):
@@ -103,7 +103,7 @@ class Contact(object):
             t.List[Message]: The messages where this contact is listed in the from field
         """
         from engine.models.message import Message
-        return [Message(message_schema, self._imap_client) for message_schema in self._schema.from_messages.all()]
+        return Message.from_queryset(MessageSchema.objects.filter(base_message__from_m=self._schema), self._imap_client)
 
     @property
     def messages_bcc(self):
@@ -114,7 +114,7 @@ class Contact(object):
             t.List[Message]: The messages where this contact is listed in the bcc field
         """
         from engine.models.message import Message
-        return [Message(message_schema, self._imap_client) for message_schema in self._schema.bcc_messages.all()]
+        return Message.from_queryset(MessageSchema.objects.filter(base_message__bcc=self._schema), self._imap_client)
 
     @property
     def messages_cc(self):
@@ -125,7 +125,7 @@ class Contact(object):
             t.List[Message]: The messages where this contact is listed in the cc field
         """
         from engine.models.message import Message
-        return [Message(message_schema, self._imap_client) for message_schema in self._schema.cc_messages.all()]
+        return Message.from_queryset(MessageSchema.objects.filter(base_message__cc=self._schema), self._imap_client)
 
     def recent_messages(self, N=3):
         # type: (t.integer) -> t.List[Message]
@@ -134,11 +134,10 @@ class Contact(object):
         Returns:
             t.List[Message]: The messages where this contact is listed in the from/to/cc/bcc field
         """
-        from browser.models.message import Message
+        from engine.models.message import Message
 
-        message_schemas = MessageSchema.objects.filter(Q(from_m=self._schema) | Q(to=self._schema) | Q(cc=self._schema) | Q(bcc=self._schema)).order_by("-date")[:N]
-        logger.debug(message_schemas.values('id'))
+        message_schemas = MessageSchema.objects.filter(Q(base_message__from_m=self._schema) | Q(base_message__to=self._schema) | Q(base_message__cc=self._schema) | Q(base_message__bcc=self._schema)).distinct().order_by("-base_message__date")[:N]
         # TODO fetch from imap 
         # self._imap_client.search('OR FROM "%s" (OR TO "%s" (OR CC "%s" BCC "%s"))' % (self.email, self.email, self.email, self.email))
-        return [Message(message_schema, self._imap_client) for message_schema in message_schemas]
+        return Message.from_queryset(message_schemas, self._imap_client)
 
@@ -206,25 +206,23 @@ class Folder(object):
 
     def _search_scheduled_message(self, event_data_list, time_start, time_end):
         message_schemas = MessageSchema.objects.filter(
-            folder=self._schema).filter(date__range=[time_start, time_end])
+            folder=self._schema).filter(base_message__date__range=[time_start, time_end])
 
         # Check if there are messages arrived+time_span between (email_rule.executed_at, now), then add them to the queue
-        for message_schema in message_schemas:
+        for message in Message.from_queryset(message_schemas, self._imap_client):
             logger.info("add schedule %s %s %s" %
-                        (time_start, message_schema.date, time_end))
-            event_data_list.append(NewMessageDataScheduled(
-                Message(message_schema, self._imap_client)))
+                        (time_start, message.date, time_end))
+            event_data_list.append(NewMessageDataScheduled(message))
 
     def _search_due_message(self, event_data_list, time_start, time_end):
         message_schemas = MessageSchema.objects.filter(
-            folder=self._schema).filter(deadline__range=[time_start, time_end])
+            folder=self._schema).filter(base_message__deadline__range=[time_start, time_end])
 
         # Check if there are messages arrived+time_span between (email_rule.executed_at, now), then add them to the queue
-        for message_schema in message_schemas:
+        for message in Message.from_queryset(message_schemas, self._imap_client):
             logger.info("add deadline queue %s %s %s" %
-                        (time_start, message_schema.deadline, time_end))
-            event_data_list.append(NewMessageDataDue(
-                Message(message_schema, self._imap_client)))
+                        (time_start, message.deadline, time_end))
+            event_data_list.append(NewMessageDataDue(message))
 
     def _should_completely_refresh(self, uid_validity):
         # type: (int) -> bool
@@ -309,13 +307,18 @@ class Folder(object):
                 event_data_list.append(NewFlagsData(
                     Message(message_schema, self._imap_client), list(flags_added)))
 
+            # only write the columns which changed, at most once per message
+            update_fields = []
             if flags_added or flags_removed:
                 message_schema.flags = list(new_flags)
-                message_schema.save()
+                update_fields.append('_flags')
 
             if message_schema.msn != message_data['SEQ']:
                 message_schema.msn = message_data['SEQ']
-                message_schema.save()
+                update_fields.append('msn')
+
+            if update_fields:
+                message_schema.save(update_fields=update_fields)
 
         logger.debug("%s updated flags" % self)
         if highest_mod_seq is not None:
@@ -567,8 +570,10 @@ class Folder(object):
             v = fields[k]
             # nested comments cannot be queried with regex
             # this hack removes them from the inside out
-            while header_comment_regex.search(v):
-                v = header_comment_regex.sub('', v)
+            # subn reports whether anything was removed so each pass scans once
+            removed = '(' in v
+            while removed:
+                v, removed = header_comment_regex.subn('', v)
             fields[k] = v
         return fields
 
@@ -2,10 +2,11 @@ import email
 import logging
 import pprint
 import typing as t
-from collections import Sequence
+from collections import Sequence, defaultdict
 from contextlib import contextmanager
 
 from engine.utils import InvalidFlagException, is_gmail_label
+from schema.youps import MessageSchema
 
 if t.TYPE_CHECKING:
     from engine.models.message import Message
@@ -40,13 +41,14 @@ def _open_rfc822(message):
         response = response[message._uid]
 
         # get the rfc data we're looking for
-        if 'RFC822' not in response:
+        raw_message = response.get('RFC822')  # type: t.Optional[bytes]
+        if raw_message is None:
             logger.critical('%s:%s response: %s' %
                             (message.folder, message, pprint.pformat(response)))
             logger.critical("%s did not return RFC822" % message)
             raise RuntimeError("Failed to get message content")
         rfc_contents = email.message_from_string(
-            response.get('RFC822'))  # type: email.message.Message
+            raw_message)  # type: email.message.Message
         yield rfc_contents
     finally:
         # if the message was read mark it as unread
@@ -81,65 +83,73 @@ def _get_text_from_python_message(part):
 # TODO refactor this to do some kind of visitor pattern or something
 # make things open to extension but closed for modification
 def get_content_from_message(message, return_only_text=True):
-    # type: (Message) -> None
+    # type: (Message, bool) -> t.Union[t.Optional[t.AnyStr], t.Dict[t.AnyStr, t.Any]]
     with _open_rfc822(message) as rfc_contents:
-        text = ""
-        html = ""
-        extra = {}
-
-        # walk the message
-        for part in rfc_contents.walk():
-            # TODO respect multipart/[alternative, mixed] etc... see RFC1341
-            if part.is_multipart():
-                continue
-
-            # for each part get the maintype and subtype
-            sub_type = part.get_content_subtype()
-
-            text_contents = _get_text_from_python_message(part)
-
-            # extract plain text
-            if text_contents is not None:
-                text += text_contents if sub_type == "plain" else ""
-                html += text_contents if sub_type == "html" else ""
-            # extract calendar
-            elif sub_type == "calendar":
-                if sub_type not in extra:
-                    extra[sub_type] = ""
-                extra[sub_type] += text_contents
-            # fail otherwise
-            else:
-                logger.critical(
-                    "%s unsupported sub type %s" % (message, sub_type))
-                raise NotImplementedError(
-                    "Unsupported sub type %s" % sub_type)
-
-        # I think this is less confusing than returning an empty string - LM
-        text = text if text else None
-        html = html if html else None
-        # return text if we have it otherwise html
-        # return text if text else html
-        if return_only_text:
-            return text
+        return get_content_from_python_message(message, rfc_contents, return_only_text)
+
+
+def get_content_from_python_message(message, rfc_contents, return_only_text=True):
+    # type: (Message, email.message.Message, bool) -> t.Union[t.Optional[t.AnyStr], t.Dict[t.AnyStr, t.Any]]
+    text = ""
+    html = ""
+    extra = {}
+
+    # walk the message
+    for part in rfc_contents.walk():
+        # TODO respect multipart/[alternative, mixed] etc... see RFC1341
+        if part.is_multipart():
+            continue
+
+        # for each part get the maintype and subtype
+        sub_type = part.get_content_subtype()
+
+        text_contents = _get_text_from_python_message(part)
+
+        # extract plain text
+        if text_contents is not None:
+            text += text_contents if sub_type == "plain" else ""
+            html += text_contents if sub_type == "html" else ""
+        # extract calendar
+        elif sub_type == "calendar":
+            if sub_type not in extra:
+                extra[sub_type] = ""
+            extra[sub_type] += text_contents
+        # fail otherwise
         else:
-            extra['text'] = text
-            extra['html'] = html
+            logger.critical(
+                "%s unsupported sub type %s" % (message, sub_type))
+            raise NotImplementedError(
+                "Unsupported sub type %s" % sub_type)
+
+    # I think this is less confusing than returning an empty string - LM
+    text = text if text else None
+    html = html if html else None
+    # return text if we have it otherwise html
+    # return text if text else html
+    if return_only_text:
+        return text
+    else:
+        extra['text'] = text
+        extra['html'] = html
 
-            return extra
+        return extra
 
 def _flag_change_helper(message, uids, flags, gmail_label_func, imap_flag_func):
     # type: (Message, t.List[int], t.List[str], t.Callable[[t.List[int], t.List[str]]])
     import pprint
     flags = _check_flags(message, flags)
     if message._imap_account.is_gmail:
+        # skip the round trip for whichever kind of flag was not passed
         gmail_labels = filter(is_gmail_label, flags)
-        returned_labels = gmail_label_func(uids, gmail_labels)
-        logger.debug("flag change returned labels {flags}".format(
-            flags=pprint.pformat(returned_labels)))
+        if gmail_labels:
+            returned_labels = gmail_label_func(uids, gmail_labels)
+            logger.debug("flag change returned labels {flags}".format(
+                flags=pprint.pformat(returned_labels)))
         not_gmail_labels = filter(lambda f: not is_gmail_label(f), flags)
-        returned_flags = imap_flag_func(uids, not_gmail_labels)
-        logger.debug("flag change returned flags {flags}".format(
-            flags=pprint.pformat(returned_flags)))
+        if not_gmail_labels:
+            returned_flags = imap_flag_func(uids, not_gmail_labels)
+            logger.debug("flag change returned flags {flags}".format(
+                flags=pprint.pformat(returned_flags)))
     else:
         returned_flags = imap_flag_func(uids, flags)
         logger.debug("flag change returned flags {flags}".format(
@@ -190,4 +200,22 @@ def _save_flags(message, flags):
         message._schema.flags = flags
         message._schema.save()
 
-    message._flags = flags
\ No newline at end of file
+    message._set_local_flags(flags)
+
+
+def _save_flags_bulk(messages_and_flags):
+    # type: (t.Iterable[t.Tuple[Message, t.List[t.AnyStr]]]) -> None
+    """Save new flags for several messages to the database
+
+    Messages which end up with the same flags are written with a single
+    UPDATE instead of saving each row.
+    """
+    pks_by_flags = defaultdict(list)  # type: t.Dict[t.AnyStr, t.List[int]]
+    for message, flags in messages_and_flags:
+        if not message._is_simulate:
+            message._schema.flags = flags
+            pks_by_flags[message._schema._flags].append(message._schema.pk)
+        message._set_local_flags(flags)
+
+    for flags_json, pks in pks_by_flags.iteritems():
+        MessageSchema.objects.filter(pk__in=pks).update(_flags=flags_json)
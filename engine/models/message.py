@@ -1,19 +1,25 @@
 from __future__ import division, print_function, unicode_literals
 
 import email
-import inspect
 import logging
-import re
+import pprint
 import smtplib
+import socket
+import sys
+import threading
 import typing as t  # noqa: F401 ignore unused we use it for typing
+import weakref
 from datetime import (datetime,  # noqa: F401 ignore unused we use it for typing
                       timedelta)
 from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.parser import HeaderParser
 from itertools import ifilter, islice, chain
 
+from django.db import transaction
+from django.db.models.query import QuerySet  # noqa: F401 ignore unused we use it for typing
 from django.utils import timezone
 from imapclient import \
     IMAPClient  # noqa: F401 ignore unused we use it for typing
@@ -26,15 +32,121 @@ from http_handler.settings import CLIENT_ID
 from schema.youps import (EmailRule,  # noqa: F401 ignore unused we use it for typing
                           ImapAccount, MessageSchema, TaskManager)
 from smtp_handler.utils import format_email_address, get_attachments
-from engine.utils import IsNotGmailException
+from engine.utils import IsNotGmailException, is_gmail_label, normalize_msg_id
 from engine.models.helpers import message_helpers
 
 userLogger = logging.getLogger('youps.user')  # type: logging.Logger
 logger = logging.getLogger('youps')  # type: logging.Logger
 
+# per thread storage for open smtp connections, closed at the end of each interpret run
+_smtp_local = threading.local()
+
+
+def _get_smtp_pool():
+    # type: () -> t.Dict[t.Tuple[t.AnyStr, t.AnyStr], smtplib.SMTP]
+    """Get this thread's open smtp connections keyed by (host, email)
+    """
+    pool = getattr(_smtp_local, 'pool', None)
+    if pool is None:
+        pool = _smtp_local.pool = {}
+    return pool
+
+
+def close_smtp_connections():
+    # type: () -> None
+    """Quit and forget all of this thread's pooled smtp connections
+
+    The pool only lives for one run of the user's code so connections
+    don't pile up for every account the worker thread has sent mail for.
+    """
+    pool = _get_smtp_pool()
+    for s in pool.itervalues():
+        try:
+            s.quit()
+        except (smtplib.SMTPException, socket.error):
+            s.close()
+    pool.clear()
+
+
+# the descriptor used to fetch the in-reply-to header and the key used to read it
+_in_reply_to_field = 'BODY[HEADER.FIELDS (IN-REPLY-TO)]'
+_in_reply_to_descriptors = ['FLAGS', _in_reply_to_field]
+# bits for the system flags so the is_* checks don't scan the flag list
+_system_flag_bits = {
+    '\\Seen': 1,
+    '\\Deleted': 2,
+    '\\Recent': 4,
+    '\\Answered': 8,
+    '\\Flagged': 16,
+    '\\Draft': 32,
+}  # type: t.Dict[t.AnyStr, int]
+
+
+def _get_flag_mask(flags):
+    # type: (t.Iterable[t.AnyStr]) -> int
+    """Get the bitmask of the system flags in a list of flags
+    """
+    mask = 0
+    for flag in flags:
+        mask |= _system_flag_bits.get(flag, 0)
+    return mask
+
+
+# names of the folders known to exist for each open imap connection
+_known_folders = weakref.WeakKeyDictionary()  # type: t.MutableMapping[IMAPClient, t.Set[t.AnyStr]]
+
+# parses the fetched header block so folded headers are handled for us
+_header_parser = HeaderParser()
+
+
+# thread and folder both import this module so they are bound on first use
+Thread = None
+Folder = None
+
+
+def _import_cyclic_models():
+    # type: () -> None
+    """Bind the Thread and Folder classes at module level once both modules are loaded
+    """
+    global Thread, Folder
+    from engine.models.thread import Thread as _Thread
+    from engine.models.folder import Folder as _Folder
+    Thread, Folder = _Thread, _Folder
+
+
+class _cached_slot(object):
+    """Cache the result of a method in a __slots__ entry
+
+    Works like django's cached_property, but classes using __slots__ have no
+    instance __dict__ to store the value in, so it is kept in the slot named
+    _c_<method name> which the class has to declare.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+        self.slot = '_c_' + func.__name__
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        try:
+            return getattr(instance, self.slot)
+        except AttributeError:
+            value = self.func(instance)
+            setattr(instance, self.slot, value)
+            return value
+
 
 class Message(object):
 
+    # messages are created in bulk so don't give every instance a __dict__
+    # the _c_ slots hold the values cached by _cached_slot properties
+    __slots__ = ('_schema', '_imap_client', '_is_simulate', '_flags', '_flag_mask', '_flag_mask_json', '__weakref__',
+                 '_c_thread', '_c_to', '_c_from_', '_c_reply_to', '_c_cc', '_c_bcc',
+                 '_c_recipients', '_c_folder', '_c_content', '_c__content_lower',
+                 '_c__folder_name')
+
     # the most basic descriptors we get for all messages
     _descriptors = ['FLAGS', 'INTERNALDATE']
     # the descriptors used to get header metadata about the messages
@@ -46,6 +158,11 @@ class Message(object):
 
     _user_level_func = ['on_message']
 
+    # the foreign keys read by most properties, joined in when loading messages in bulk
+    _schema_select_related = ['base_message', 'base_message__from_m', 'folder', 'imap_account']
+    # the contact relations read by to, cc, bcc and reply_to
+    _schema_prefetch_related = ['base_message__to', 'base_message__cc', 'base_message__bcc', 'base_message__reply_to']
+
     def __init__(self, message_schema, imap_client, is_simulate=False):
         # type: (MessageSchema, IMAPClient, t.Optional[bool]) -> Message
 
@@ -57,9 +174,32 @@ class Message(object):
         # if True, then only local execute and don't transmit to the server.
         self._is_simulate = is_simulate  # type: bool
 
-        # local copy of flags for simulating
-        self._flags = self._schema.flags
-        logger.debug('caller name: %s', inspect.stack()[1][3])
+        # local copy of flags for simulating and the bitmask of its system flags
+        self._set_local_flags(self._schema.flags)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('caller name: %s', sys._getframe(1).f_code.co_name)
+
+    @classmethod
+    def from_queryset(cls, message_schemas, imap_client, is_simulate=False):
+        # type: (QuerySet, IMAPClient, t.Optional[bool]) -> t.List[Message]
+        """Create Messages from a MessageSchema queryset
+
+        This is the preferred way to create many messages. The foreign keys read by
+        most properties (base message, sender, folder and account) are joined into
+        the query and the recipient contacts are prefetched, so reading them does
+        not issue a query per message.
+
+        Args:
+            message_schemas (QuerySet): queryset of the MessageSchemas to wrap
+            imap_client (IMAPClient): the connection to the server
+            is_simulate (t.Optional[bool]): passed through to each Message
+
+        Returns:
+            t.List[Message]: the messages in the order of the queryset
+        """
+        message_schemas = message_schemas.select_related(*cls._schema_select_related) \
+            .prefetch_related(*cls._schema_prefetch_related)
+        return [cls(message_schema, imap_client, is_simulate) for message_schema in message_schemas]
 
     @staticmethod
     def _get_flag_descriptors(is_gmail):
@@ -114,7 +254,7 @@ class Message(object):
     def _uid(self, value):
         # type: (int) -> None
         self._schema.uid = value
-        self._schema.save()
+        self._schema.save(update_fields=['uid'])
 
     @property
     def _msn(self):
@@ -125,7 +265,7 @@ class Message(object):
     def _msn(self, value):
         # type: (int) -> None
         self._schema.msn = value
-        self._schema.save()
+        self._schema.save(update_fields=['msn'])
 
     @property
     def _message_id(self):
@@ -194,10 +334,11 @@ class Message(object):
         """
         return self._schema.base_message.subject
 
-    @property
+    @_cached_slot
     def thread(self):
         # type: () -> t.Optional[Thread]
-        from engine.models.thread import Thread
+        if Thread is None:
+            _import_cyclic_models()
         if self._schema.base_message._thread is not None:
             return Thread(self._schema.base_message._thread, self._imap_client, self._is_simulate, self._schema.folder)
         # TODO we should create the thread otherwise
@@ -221,7 +362,7 @@ class Message(object):
         Returns:
             bool: True if the message has been read
         """
-        return '\\Seen' in self.flags
+        return bool(self._get_system_flag_mask() & _system_flag_bits['\\Seen'])
 
     @property
     def is_unread(self):
@@ -241,7 +382,7 @@ class Message(object):
         Returns:
             bool: True if the message has been deleted
         """
-        return '\\Deleted' in self.flags
+        return bool(self._get_system_flag_mask() & _system_flag_bits['\\Deleted'])
 
     @property
     def is_recent(self):
@@ -252,9 +393,9 @@ class Message(object):
             bool: True if the message is recent
         """
         # TODO we will automatically remove the RECENT flag unless we make our imapclient ReadOnly
-        return '\\Recent' in self.flags
+        return bool(self._get_system_flag_mask() & _system_flag_bits['\\Recent'])
 
-    @property
+    @_cached_slot
     def to(self):
         # type: () -> t.List[Contact]
         """Get the Contacts the message is addressed to
@@ -265,7 +406,7 @@ class Message(object):
 
         return [Contact(contact_schema, self._imap_client) for contact_schema in self._schema.base_message.to.all()]
 
-    @property
+    @_cached_slot
     def from_(self):
         # type: () -> Contact
         """Get the Contact the message is addressed from
@@ -287,7 +428,7 @@ class Message(object):
         """
         return self.from_
 
-    @property
+    @_cached_slot
     def reply_to(self):
         # type: () -> t.List[Contact]
         """Get the Contacts the message is replied to
@@ -300,7 +441,7 @@ class Message(object):
         """
         return [Contact(contact_schema, self._imap_client) for contact_schema in self._schema.base_message.reply_to.all()]
 
-    @property
+    @_cached_slot
     def cc(self):
         # type: () -> t.List[Contact]
         """Get the Contacts the message is cced to
@@ -310,7 +451,7 @@ class Message(object):
         """
         return [Contact(contact_schema, self._imap_client) for contact_schema in self._schema.base_message.cc.all()]
 
-    @property
+    @_cached_slot
     def bcc(self):
         # type: () -> t.List[Contact]
         """Get the Contacts the message is bcced to
@@ -320,7 +461,7 @@ class Message(object):
         """
         return [Contact(contact_schema, self._imap_client) for contact_schema in self._schema.base_message.bcc.all()]
 
-    @property
+    @_cached_slot
     def recipients(self):
         # type: () -> t.List[Contact]
         """Shortcut method to get a list of all the recipients of an email.
@@ -331,9 +472,16 @@ class Message(object):
         Returns:
             t.List[Contact]: All the visible recipients of an email
         """
-        return list(set(chain(self.to, self.cc, self.bcc)))
-
-    @property
+        # dedup on the contact schema id, Contact does not define __hash__
+        seen = set()  # type: t.Set[int]
+        recipients = []  # type: t.List[Contact]
+        for contact in chain(self.to, self.cc, self.bcc):
+            if contact._schema.pk not in seen:
+                seen.add(contact._schema.pk)
+                recipients.append(contact)
+        return recipients
+
+    @_cached_slot
     def folder(self):
         # type: () -> Folder
         """Get the Folder the message is contained in
@@ -341,10 +489,11 @@ class Message(object):
         Returns:
             Folder: the folder that the message is contained in
         """
-        from engine.models.folder import Folder
+        if Folder is None:
+            _import_cyclic_models()
         return Folder(self._schema.folder, self._imap_client)
 
-    @property
+    @_cached_slot
     def content(self, return_only_text=True):
         # type: () -> t.AnyStr
         """Get the content of the message
@@ -361,16 +510,42 @@ class Message(object):
         Returns:
             bool: True if the flag is on the message else false
         """
+        bit = _system_flag_bits.get(flag)
+        if bit is not None:
+            return bool(self._get_system_flag_mask() & bit)
         return flag in self.flags
 
+    def _set_local_flags(self, flags):
+        # type: (t.List[t.AnyStr]) -> None
+        """Set the local copy of the flags and keep the system flag bitmask in sync
+        """
+        self._flags = flags
+        self._flag_mask = _get_flag_mask(flags)
+        # the mask now describes the local flags not the schema's
+        self._flag_mask_json = None
+
+    def _get_system_flag_mask(self):
+        # type: () -> int
+        """Get the bitmask of the system flags from the same source as flags
+
+        Outside of simulation the schema flags can be assigned after the message
+        is created so the mask is recomputed whenever the stored flags change.
+        """
+        if self._is_simulate:
+            return self._flag_mask
+        flags_json = self._schema._flags
+        if flags_json != self._flag_mask_json:
+            self._flag_mask = _get_flag_mask(self._schema.flags)
+            self._flag_mask_json = flags_json
+        return self._flag_mask
+
     def add_flags(self, flags):
         # type: (t.Union[t.Iterable[t.AnyStr], t.AnyStr]) -> None
         """Add each of the flags in a list of flags to the message
 
         This method can also optionally take a single string as a flag.
         """
-        if self._is_simulate:
-            flags = message_helpers._check_flags(self, flags)
+        flags = message_helpers._check_flags(self, flags)
         # add known flags to the correct place. i.e. \\Seen flag is not a gmail label
         if not self._is_simulate:
             message_helpers._flag_change_helper(self, self._uid, flags, self._imap_client.add_gmail_labels, self._imap_client.add_flags)
@@ -383,8 +558,7 @@ class Message(object):
 
         This method can also optionally take a single string as a flag.
         """
-        if self._is_simulate:
-            flags = message_helpers._check_flags(self, flags)
+        flags = message_helpers._check_flags(self, flags)
         if not self._is_simulate:
             message_helpers._flag_change_helper(self, self._uid, flags, self._imap_client.remove_gmail_labels, self._imap_client.remove_flags)
 
@@ -445,25 +619,35 @@ class Message(object):
         # type: (t.AnyStr) -> bool
         """check if a string is contained in the content of a message
 
+        The check ignores case.
+
         Args:
             string (str): string to check for
 
         Returns:
             bool: true if the passed in string is in the message content
         """
-        return string in self.content
+        return string.lower() in self._content_lower
+
+    @_cached_slot
+    def _content_lower(self):
+        # type: () -> t.AnyStr
+        # parsed and lowercased once so repeated contains calls only scan the text
+        content = self.content
+        if isinstance(content, dict):
+            content = (content.get('text') or '') + (content.get('html') or '')
+        return (content or '').lower()
 
     def reply(self, to=[], cc=[], bcc=[], content=""):
         # type: (t.Iterable[t.AnyStr], t.Iterable[t.AnyStr], t.Iterable[t.AnyStr], t.AnyStr) -> None
         """Reply to the sender of this message
         """
         if not self._is_simulate:
-            to_addr = ""
+            # build a new list so the caller's list (or the default) is never mutated
             if isinstance(to, list):
-                to_addr = to.append(self._schema.from_)
-                to = format_email_address(to_addr)
+                to = format_email_address(to + [self.from_])
             else:
-                to = format_email_address([self._schema.from_, to])
+                to = format_email_address([self.from_, to] if to else [self.from_])
 
             cc = format_email_address(cc)
             bcc = format_email_address(bcc)
@@ -475,21 +659,14 @@ class Message(object):
                 self._send_message(new_message_wrapper)
 
     def reply_all(self, more_to=[], more_cc=[], more_bcc=[], content=""):
-        if isinstance(more_cc, list):
-            if len(self.cc) > 0:
-                more_cc = more_cc + self.cc
+        # a single address can be passed instead of a list
+        if not isinstance(more_cc, list):
+            more_cc = [more_cc] if more_cc else []
+        if not isinstance(more_bcc, list):
+            more_bcc = [more_bcc] if more_bcc else []
 
-        else:
-            if more_cc:
-                more_cc = self.cc + more_cc
-
-        if isinstance(more_bcc, list):
-            if len(self.bcc) > 0:
-                more_bcc = more_bcc + self.bcc
-
-        else:
-            if more_bcc:
-                more_bcc = self.bcc + more_bcc
+        more_cc = more_cc + self.cc
+        more_bcc = more_bcc + self.bcc
 
         self.reply(more_to, more_cc, more_bcc, content)
 
@@ -507,22 +684,23 @@ class Message(object):
             later_at = timezone.now().replace(microsecond=0) + \
                 timedelta(seconds=later_at*60)
 
-        current_folder = self._schema.folder.name
+        current_folder = self._folder_name
         if self._schema.imap_account.is_gmail and current_folder == "INBOX":
             current_folder = 'inbox'
 
         if not self._is_simulate:
             self.move(hide_in)
 
-            import random
-
-            er = EmailRule(uid=random.randint(1, 100000), name='see later', type='see-later',
-                           code='imap.select_folder("%s")\nmsg=imap.search(["HEADER", "Message-ID", "%s"])\nif msg:\n    imap.move(msg, "%s")' % (hide_in, self._message_id, current_folder))
-            er.save()
+            # see later rules have no mode so the default uid can't collide
+            # save the rule and its task together so a rule never exists without its task
+            with transaction.atomic():
+                er = EmailRule(name='see later', type='see-later',
+                               code='imap.select_folder("%s")\nmsg=imap.search(["HEADER", "Message-ID", "%s"])\nif msg:\n    imap.move(msg, "%s")' % (hide_in, self._message_id, current_folder))
+                er.save()
 
-            t = TaskManager(email_rule=er, date=later_at,
-                            imap_account=self._schema.imap_account)
-            t.save()
+                t = TaskManager(email_rule=er, date=later_at,
+                                imap_account=self._schema.imap_account)
+                t.save()
             logger.critical("here %s" % hide_in)
 
         print("see_later(): Hide the message until %s at %s" %
@@ -541,60 +719,65 @@ class Message(object):
             return list(islice(other_messages, N))
 
         else:
-            cnt_n = 0
-            uid_to_fecth = self._uid
-            prev_msg_id = None
-            prev_messages = []
-            logger.critical("recentmessages ")
-            while cnt_n < N:
-                if uid_to_fecth is None and prev_msg_id:
-                    prev_msg_schema = MessageSchema.objects.filter(
-                        folder__name=self.folder.name, message_id=prev_msg_id)
-                    if prev_msg_schema.exists():
-                        uid_to_fecth = prev_msg_schema[0].uid
-                    else:
-                        break
-                    # uid_to_fecth = self._imap_client.search(["HEADER", "Message-ID", prev_msg_id])
-
-                if uid_to_fecth:
-                    in_reply_to_field = 'BODY[HEADER.FIELDS (IN-REPLY-TO)]'
-                    prev_msg = self._imap_client.fetch(
-                        [uid_to_fecth], ['FLAGS', in_reply_to_field])
-                else:
+            prev_messages = []  # type: t.List[Message]
+            seen_ids = {self._message_id}
+            current = self  # type: Message
+            # the references header lists the ancestors oldest first so the
+            # closest N can be looked up with one query
+            parent_ids = self.references[::-1][:N] or self.in_reply_to[:1]
+            while len(prev_messages) < N:
+                if not parent_ids and current._schema.folder_id == self._schema.folder_id:
+                    # the stored headers don't name a parent so ask the server
+                    parent_ids = self._fetch_in_reply_to(current._uid)
+                parent_ids = [msg_id for msg_id in parent_ids if msg_id not in seen_ids]
+                if not parent_ids:
                     break
-
-                # TODO check if it is read
-                for key, value in prev_msg.iteritems():
-                    v = value[in_reply_to_field]
-                    v.replace('\r\n\t', ' ')
-                    v = v.replace('\r\n', ' ')
-
-                    if not v:
-                        continue
-
-                    prev_msg_id = re.split(
-                        '(IN-REPLY-TO:|In-Reply-To:)', v.strip())[-1].strip()
-                    logger.critical(prev_msg_id)
-                    uid_to_fecth = None
-
-                    m_schema = MessageSchema.objects.filter(
-                        message_id=prev_msg_id)
-                    logger.critical(m_schema)
-                    if m_schema.exists():
-                        prev_messages.append(
-                            Message(m_schema[0], self._imap_client))
-                    # else:
-                    #     break
-                    # TODO message repr()
-                    # TODO move run_simulate spinning bar under the table, not global
-
-                cnt_n = cnt_n + 1
+                found = self._find_messages_by_message_id(parent_ids)
+                if not found:
+                    break
+                prev_messages.extend(found)
+                seen_ids.update(m._message_id for m in found)
+                # keep walking up the reply chain from the oldest message found
+                current = found[-1]
+                parent_ids = current.in_reply_to[:1]
             # TODO mark as unread
 
-            return prev_messages
+            return prev_messages[:N]
+
+    def _find_messages_by_message_id(self, msg_ids):
+        # type: (t.List[t.AnyStr]) -> t.List[Message]
+        """Get the stored messages with the passed in message ids
+
+        If a message is stored in several folders the copy in this message's
+        folder is preferred.
+
+        Returns:
+            t.List[Message]: the messages found, in the order of msg_ids
+        """
+        message_schemas = MessageSchema.objects.filter(
+            imap_account=self._schema.imap_account_id, base_message__message_id__in=msg_ids
+        ).select_related(*Message._schema_select_related)
+        schema_map = {}  # type: t.Dict[t.AnyStr, MessageSchema]
+        for message_schema in message_schemas:
+            msg_id = message_schema.base_message.message_id
+            if msg_id not in schema_map or message_schema.folder_id == self._schema.folder_id:
+                schema_map[msg_id] = message_schema
+        return [Message(schema_map[msg_id], self._imap_client) for msg_id in msg_ids if msg_id in schema_map]
+
+    def _fetch_in_reply_to(self, uid):
+        # type: (int) -> t.List[t.AnyStr]
+        """Fetch the in-reply-to header of a message in the selected folder from the server
+
+        Returns:
+            t.List[t.AnyStr]: the message ids in the in-reply-to header
+        """
+        response = self._imap_client.fetch([uid], _in_reply_to_descriptors)
+        v = response.get(uid, {}).get(_in_reply_to_field)
+        if not v:
+            return []
+        return normalize_msg_id(_header_parser.parsestr(v, headersonly=True).get('In-Reply-To', ''))
 
     def _create_message_instance(self, subject='', to='', cc='', bcc='', additional_content=''):
-        import pprint
         new_message_wrapper = MIMEMultipart('mixed')
 
         new_message_wrapper["Subject"] = subject
@@ -616,32 +799,33 @@ class Message(object):
                 raise RuntimeError('Invalid response missing UID')
             response = response[self._uid]
 
-            if 'RFC822' not in response:
+            raw_message = response.get('RFC822')  # type: t.Optional[bytes]
+            if raw_message is None:
                 logger.critical('%s:%s response: %s' %
                                 (self.folder, self, pprint.pformat(response)))
                 logger.critical("%s did not return RFC822" % self)
                 raise RuntimeError("Could not find RFC822")
 
-            # text content
+            # the fetched payload is a byte string so this parses it in place
+            rfc_contents = email.message_from_string(
+                raw_message)  # type: email.message.Message
+
+            # text content, read from the message we already fetched
             new_message = MIMEMultipart('alternative')
 
-            content = self.content
+            content = message_helpers.get_content_from_python_message(self, rfc_contents, return_only_text=False)
             separator = "On %s, (%s) wrote:" % (
                 datetime.now().ctime(), self._schema.imap_account.email)
-            text_content = additional_content + "\n\n" + \
-                separator + "\n\n" + content["text"]
-            html_content = additional_content + "<br><br>" + \
-                separator + "<br><br>" + content["html"]
+            text_content = "".join((additional_content, "\n\n", separator, "\n\n", content["text"] or ""))
+            html_content = "".join((additional_content, "<br><br>", separator, "<br><br>", content["html"] or ""))
 
-            part1 = MIMEText(text_content.encode('utf-8'), 'plain')
-            part2 = MIMEText(html_content.encode('utf-8'), 'html')
+            # MIMEText encodes the unicode bodies once and labels the charset
+            part1 = MIMEText(text_content, 'plain', 'utf-8')
+            part2 = MIMEText(html_content, 'html', 'utf-8')
             new_message.attach(part1)
             new_message.attach(part2)
 
             # get attachments
-            rfc_contents = email.message_from_string(
-                response.get('RFC822'))  # type: email.message.Message
-
             res = get_attachments(rfc_contents)
 
             attachments = res['attachments']
@@ -672,32 +856,84 @@ class Message(object):
 
     def _send_message(self, new_message_wrapper):
         try:
-            # SMTP authenticate
-            if self._schema.imap_account.is_gmail:
-                oauth = GoogleOauth2()
-                response = oauth.RefreshToken(
-                    self._schema.imap_account.refresh_token)
-
-                auth_string = oauth.generate_oauth2_string(
-                    self._schema.imap_account.email, response['access_token'], as_base64=True)
-                s = smtplib.SMTP('smtp.gmail.com', 587)
-                s.ehlo(CLIENT_ID)
-                s.starttls()
-                s.docmd('AUTH', 'XOAUTH2 ' + auth_string)
-
-            else:
-                s = smtplib.SMTP(
-                    self._schema.imap_account.host.replace("imap", "smtp"), 587)
-                s.login(self._schema.imap_account.email, decrypt_plain_password(
-                    self._schema.imap_account.password))
-                s.ehlo()
+            s = self._get_smtp_connection()
 
             # TODO check if it sent to cc-ers
             s.sendmail(self._schema.imap_account.email,
                        new_message_wrapper["To"], new_message_wrapper.as_string())
         except Exception as e:
+            # don't reuse a connection which failed
+            self._drop_smtp_connection()
             print (e)
 
+    def _get_smtp_key(self):
+        # type: () -> t.Tuple[t.AnyStr, t.AnyStr]
+        """Get the key identifying this account's smtp connection
+
+        Returns:
+            t.Tuple[t.AnyStr, t.AnyStr]: the smtp host and the account email
+        """
+        imap_account = self._schema.imap_account
+        host = 'smtp.gmail.com' if imap_account.is_gmail else imap_account.host.replace("imap", "smtp")
+        return host, imap_account.email
+
+    def _get_smtp_connection(self):
+        # type: () -> smtplib.SMTP
+        """Get an authenticated smtp connection for this account
+
+        Connections are kept open per thread until close_smtp_connections is
+        called at the end of the run and reused as long as the server still
+        answers a NOOP, so sending several messages only connects and
+        authenticates once.
+
+        Returns:
+            smtplib.SMTP: authenticated smtp connection
+        """
+        pool = _get_smtp_pool()
+        key = self._get_smtp_key()
+        s = pool.get(key)
+        if s is not None:
+            try:
+                if s.noop()[0] == 250:
+                    return s
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self._drop_smtp_connection()
+
+        imap_account = self._schema.imap_account
+        host = key[0]
+        # SMTP authenticate
+        if imap_account.is_gmail:
+            oauth = GoogleOauth2()
+            response = oauth.RefreshToken(imap_account.refresh_token)
+
+            auth_string = oauth.generate_oauth2_string(
+                imap_account.email, response['access_token'], as_base64=True)
+            s = smtplib.SMTP(host, 587)
+            s.ehlo(CLIENT_ID)
+            s.starttls()
+            s.docmd('AUTH', 'XOAUTH2 ' + auth_string)
+
+        else:
+            s = smtplib.SMTP(host, 587)
+            s.login(imap_account.email, decrypt_plain_password(
+                imap_account.password))
+            s.ehlo()
+
+        pool[key] = s
+        return s
+
+    def _drop_smtp_connection(self):
+        # type: () -> None
+        """Close and forget this account's pooled smtp connection if there is one
+        """
+        s = _get_smtp_pool().pop(self._get_smtp_key(), None)
+        if s is not None:
+            try:
+                s.close()
+            except Exception:
+                pass
+
     def _append_original_text(self, text, html, orig, google=False):
         """
         Append each part of the orig message into 2 new variables
@@ -737,8 +973,15 @@ class Message(object):
 
         return (text+'\n\n'+newtext, html+'<br/>'+newhtml)
 
+    @_cached_slot
+    def _folder_name(self):
+        # type: () -> t.AnyStr
+        return self._schema.folder.name
+
     def _is_message_already_in_dst_folder(self, dst_folder):
-        if dst_folder == self._schema.folder.name:
+        # gmail folder names such as INBOX are case insensitive
+        if dst_folder == self._folder_name or \
+                (self._imap_account.is_gmail and dst_folder.lower() == self._folder_name.lower()):
             userLogger.info(
                 "message already in destination folder: %s" % dst_folder)
             return True
@@ -747,10 +990,15 @@ class Message(object):
     def _check_folder(self, dst_folder):
         if not isinstance(dst_folder, basestring):
             raise TypeError("folder named must be a string")
+        # folders known to exist on this connection, saves a LIST per move or copy
+        known_folders = _known_folders.setdefault(self._imap_client, set())
+        if dst_folder in known_folders:
+            return
         if not self._imap_client.folder_exists(dst_folder):
             userLogger.info(
                 "folder %s does not exist creating it for you" % dst_folder)
             self._imap_client.create_folder(dst_folder)
+        known_folders.add(dst_folder)
 
 
     def _get_from_friendly(self):
@@ -765,28 +1013,20 @@ class Message(object):
         return {}
 
     def _get_to_friendly(self):
-        to = []
-        for contact in self.to:
-            to.append({
-                "name": contact.name,
-                "email": contact.email,
-                "organization": contact.organization,
-                "geolocation": contact.geolocation
-            })
-
-        return to
+        return self._get_contacts_friendly(self.to)
 
     def _get_cc_friendly(self):
-        to = []
-        for contact in self.cc:
-            to.append({
-                "name": contact.name,
-                "email": contact.email,
-                "organization": contact.organization,
-                "geolocation": contact.geolocation
-            })
+        return self._get_contacts_friendly(self.cc)
 
-        return to
+    @staticmethod
+    def _get_contacts_friendly(contacts):
+        # type: (t.Iterable[Contact]) -> t.List[t.Dict[t.AnyStr, t.Any]]
+        return [{
+            "name": contact.name,
+            "email": contact.email,
+            "organization": contact.organization,
+            "geolocation": contact.geolocation
+        } for contact in contacts]
 
     def _get_meta_data_friendly(self):
         return {
@@ -803,15 +1043,7 @@ class Message(object):
 
     def add_flags_gmail(self, flags):
         # TODO see remove_flags_gmail same issue applies here
-        if not self._imap_account.is_gmail:
-            raise IsNotGmailException()
-        if self._is_simulate:
-            flags = message_helpers._check_flags(self, flags)
-        uids = [m._uid for m in self.thread]
-        if not self._is_simulate:
-            message_helpers._flag_change_helper(self, uids, flags, self._imap_client.add_gmail_labels, self._imap_client.add_flags)
-        for m in self.thread:
-            message_helpers._save_flags(m, list(set(m.flags + flags)))
+        self.store_flags_gmail(add=flags)
 
     def remove_flags_gmail(self, flags):
 
@@ -820,42 +1052,103 @@ class Message(object):
         # and then for each of those related messages if it contains a flag we want to remove
         # this from we need to remove that flag. but that requires calling imap_client.select_folder() which
         # i want to avoid
+        self.store_flags_gmail(remove=flags)
+
+    def store_flags_gmail(self, add=[], remove=[]):
+        # type: (t.Union[t.Iterable[t.AnyStr], t.AnyStr], t.Union[t.Iterable[t.AnyStr], t.AnyStr]) -> None
+        """Add and remove flags on every message in this message's thread
+
+        The thread is loaded once and its flags are saved in one batch, so moving
+        a thread between labels (e.g. Inbox to Trash) does not repeat the whole
+        update for each list of flags.
 
+        Args:
+            add (t.Union[t.Iterable[t.AnyStr], t.AnyStr]): flags to add
+            remove (t.Union[t.Iterable[t.AnyStr], t.AnyStr]): flags to remove
+        """
         if not self._imap_account.is_gmail:
             raise IsNotGmailException()
-        uids = [m._uid for m in self.thread]
+        add = message_helpers._check_flags(self, add) if add else []
+        remove = message_helpers._check_flags(self, remove) if remove else []
+        thread_messages = list(self.thread)
+        uids = [m._uid for m in thread_messages]
         if not self._is_simulate:
-            message_helpers._flag_change_helper(self, uids, flags, self._imap_client.remove_gmail_labels, self._imap_client.remove_flags)
-        for m in self.thread:
-            message_helpers._save_flags(m, list(set(m.flags) - set(flags)))
+            # gmail labels and imap flags are stored with different items
+            ops = []  # type: t.List[t.Tuple[t.AnyStr, t.List[t.AnyStr]]]
+            for sign, flags in (('+', add), ('-', remove)):
+                labels = [f for f in flags if is_gmail_label(f)]
+                other_flags = [f for f in flags if not is_gmail_label(f)]
+                if labels:
+                    ops.append((sign + 'X-GM-LABELS.SILENT', labels))
+                if other_flags:
+                    ops.append((sign + 'FLAGS.SILENT', other_flags))
+            self._pipelined_store(uids, ops)
+        self._save_thread_flags([(m, sorted(set(m.flags).union(add).difference(remove))) for m in thread_messages])
+
+    def _pipelined_store(self, uids, ops):
+        # type: (t.List[int], t.List[t.Tuple[t.AnyStr, t.List[t.AnyStr]]]) -> None
+        """Send several UID STORE commands before reading any of their responses
+
+        Every command is written to the connection first and the tagged responses
+        are read afterwards, so all the changes cost one round trip (RFC 3501 5.5).
+        imapclient has no pipelining api so this uses the underlying imaplib
+        connection. The .SILENT items keep the server from sending untagged FETCH
+        responses which would otherwise show up in the next fetch.
+
+        Args:
+            uids (t.List[int]): the uids of the messages to change
+            ops (t.List[t.Tuple[t.AnyStr, t.List[t.AnyStr]]]): pairs of store item, e.g. +FLAGS.SILENT,
+                and the flags to store, the flags are sent unquoted like imapclient does
+        """
+        if not uids or not ops:
+            return
+        imap = self._imap_client._imap
+        uid_set = ','.join(str(uid) for uid in uids)
+        tags = [imap._command('UID', 'STORE', uid_set, item, '(%s)' % ' '.join(flags))
+                for item, flags in ops]
+        try:
+            for tag in tags:
+                typ, data = imap._command_complete('UID', tag)
+                if typ != 'OK':
+                    raise self._imap_client.Error('UID STORE failed: %s' % data)
+        finally:
+            # drop anything the server sent anyway so it isn't mistaken for a later fetch
+            imap.untagged_responses.pop('FETCH', None)
+
+    def _save_thread_flags(self, messages_and_flags):
+        # type: (t.List[t.Tuple[Message, t.List[t.AnyStr]]]) -> None
+        # flags are sorted so messages with the same set share one UPDATE
+        message_helpers._save_flags_bulk(messages_and_flags)
+        # the thread yields new Message objects so keep our local copy in sync
+        for m, flags in messages_and_flags:
+            if m._schema.pk == self._schema.pk:
+                self._set_local_flags(flags)
+                if not self._is_simulate:
+                    self._schema.flags = flags
 
     def mark_spam_gmail(self):
         # marks all emails in the thread as spam
         # gmail does this by removing the Inbox flag and adding the spam flag
-        self.add_flags_gmail('\\Spam')
-        self.remove_flags_gmail('\\Inbox')
+        self.store_flags_gmail(add=['\\Spam'], remove=['\\Inbox'])
 
     def unmark_spam_gmail(self):
         # unmark any email which has been marked as spam
-        self.remove_flags_gmail('\\Spam')
-        self.add_flags_gmail('\\Inbox')
+        self.store_flags_gmail(add=['\\Inbox'], remove=['\\Spam'])
 
     def archive_gmail(self):
         # marks all emails in the thread as archived
         # gmail does this by removing the Inbox, Spam, and Trash labels
-        self.remove_flags_gmail(['\\Spam', '\\Inbox', '\\Trash'])
+        self.store_flags_gmail(remove=['\\Spam', '\\Inbox', '\\Trash'])
 
     def unarchive_gmail(self):
         # unarchive any messages that have been archived
-        self.add_flags_gmail(['\\Inbox'])
+        self.store_flags_gmail(add=['\\Inbox'])
 
     def delete_gmail(self):
         # marks all emails in the thread as deleted
         # gmail does this by removing the Inbox label, and adding the Trash label
-        self.remove_flags_gmail(['\\Inbox'])
-        self.add_flags_gmail(['\\Trash'])
+        self.store_flags_gmail(add=['\\Trash'], remove=['\\Inbox'])
 
     def undelete_gmail(self):
         # undelete any deleted email
-        self.add_flags_gmail(['\\Inbox'])
-        self.remove_flags_gmail(['\\Trash'])
\ No newline at end of file
+        self.store_flags_gmail(add=['\\Inbox'], remove=['\\Trash'])
\ No newline at end of file
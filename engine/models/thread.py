@@ -8,7 +8,6 @@ from schema.youps import MessageSchema, ThreadSchema, FolderSchema  # noqa: F401
 
 from engine.models.message import Message
 
-from itertools import chain, ifilter
 
 import logging 
 
@@ -65,7 +64,9 @@ class Thread(object):
         Returns:
             t.Iterator[Message]: iterator of the messages in the thread in ascending order
         """
-        base_messages = self._schema.baseMessages.all().order_by('date').iterator()
-        messages = chain.from_iterable(m.messages.all().iterator() for m in base_messages)
-        filter_messages_by_folder = ifilter(lambda m: m.folder == self._folder_schema if self._folder_schema is not None else True, messages)
-        return iter((Message(m, self._imap_client, self._is_simulate) for m in filter_messages_by_folder))
+        # one query for all the messages in the thread instead of one per base message
+        message_schemas = MessageSchema.objects.filter(base_message___thread=self._schema)
+        if self._folder_schema is not None:
+            message_schemas = message_schemas.filter(folder=self._folder_schema)
+        message_schemas = message_schemas.order_by('base_message__date', 'id')
+        return iter(Message.from_queryset(message_schemas, self._imap_client, self._is_simulate))
@@ -3,9 +3,15 @@
 import logging
 import re
 import typing as t  # noqa: F401 ignore unused we use it for typing
-from itertools import izip, tee
+from itertools import islice, tee
+
+try:
+    from itertools import izip
+except ImportError:  # python 3
+    izip = zip
 
 if t.TYPE_CHECKING:
+    from datetime import datetime
     from engine.models.message import Message
     from engine.models.folder import Folder
     from schema.youps import ImapAccount, MessageSchema, FolderSchema, BaseMessage  # noqa: F401 ignore unused we use it for typing
@@ -40,6 +46,15 @@ class InvalidFlagException(YoupsException):
         super(InvalidFlagException, self).__init__(*args, **kwargs)
 
 
+# the system labels gmail exposes as flags
+_known_gmail_labels = frozenset([u'\\Inbox', u'\\AllMail', u'\\Draft', u'\\Important',
+                                 u'\\Sent', u'\\Spam', u'\\Starred', u'\\Trash'])
+
+# the system flags defined by the imap rfc
+_known_imap_flags = frozenset(["\\Seen", "\\Answered", "\\Flagged",
+                               "\\Deleted", "\\Draft", "\\Recent"])
+
+
 def grouper(iterable, n):
     """Group data from an iterable into chunks of size n
 
@@ -52,9 +67,13 @@ def grouper(iterable, n):
     Returns:
         t.Iterable: iterable containing n elements
     """
-    # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx
-    args = [iter(iterable)] * n
-    return izip(*args)
+    # grouper('ABCDEFG', 3) --> ABC DEF G
+    it = iter(iterable)
+    while True:
+        chunk = tuple(islice(it, n))
+        if not chunk:
+            return
+        yield chunk
 
 
 def pairwise(iterable):
@@ -73,10 +92,7 @@ def is_gmail_label(possible_label):
     Returns:
         bool: true if the label is a gmail label
     """
-
-    known_labels = {u'\\Inbox', u'\\AllMail', u'\\Draft',
-                    u'\\Important', u'\\Sent', u'\\Spam', u'\\Starred', u'\\Trash'}
-    return possible_label in known_labels
+    return possible_label in _known_gmail_labels
     # TODO if we want to recognize user labels as well requires imapclient
     # # gmail labels are folders which don't start with [Gmail]
     # all_labels = {f[2] for f in imap_client.list_folders()
@@ -91,9 +107,7 @@ def is_imap_flag(possible_flag):
     Returns:
         bool: true if the label is an imap flag 
     """
-    known_flags = {"\\Seen", "\\Answered", "\\Flagged",
-                   "\\Deleted", "\\Draft", "\\Recent"}
-    return possible_flag in known_flags
+    return possible_flag in _known_imap_flags
 
 
 def normalize_msg_id(message_id):
@@ -103,22 +117,21 @@ def normalize_msg_id(message_id):
     This method will try to make message ids standardized. So that they can be
     compared with one another. They may have to be destandardized to be used as 
     headers in emails. 
+
+    Malformed ids, ones without an @ or containing quotes or angle brackets,
+    are skipped rather than raising an error.
+
     Returns:
         str: standard message_id for comparison with other message ids
     """
-    # clean up empty strings
-    message_ids = message_id_split_regex.findall(message_id)
-
     # TODO better sanity checking from rfc5322
-    # sanity check
-    for message_id in message_ids:
-        assert '@' in message_id
-        assert not any(s in message_id for s in ['>', '"', '<'])
-    return message_ids
+    # the regex only matches ids which pass the sanity check
+    return message_id_split_regex.findall(message_id)
 
 
 def strip_wrapping_quotes(string):
-    if string[0] == '"' and string[-1] == '"':
+    # a single " is not wrapped in quotes and empty strings have nothing to strip
+    if len(string) >= 2 and string[0] == '"' == string[-1]:
         return string[1:-1]
     return string
 
@@ -135,27 +148,70 @@ def message_from_message_id(msg_id, imap_account, folder, imap_client):
         bool: true if the message exists in the database
     """
     from engine.models.message import Message
-    from schema.youps import ImapAccount, MessageSchema, BaseMessage
+    from schema.youps import MessageSchema
 
     try:
-        base_message = BaseMessage.objects.get(
-            message_id=msg_id, imap_account=imap_account)
-        message_schema = MessageSchema.objects.get(
-            folder=folder._schema, imap_account=imap_account, base_message=base_message)
-    except (BaseMessage.DoesNotExist, MessageSchema.DoesNotExist):
+        message_schema = MessageSchema.objects.select_related(*Message._schema_select_related).get(
+            folder=folder._schema, imap_account=imap_account, base_message__message_id=msg_id)
+    except MessageSchema.DoesNotExist:
         return None
     return Message(message_schema, imap_client)
 
 
+class _ThreadNode(object):
+    """A node in the tree built by references_algorithm
+
+    Children are kept in a plain list so linking a node is an append instead of
+    rebuilding the parent's children on every assignment.
+    """
+    __slots__ = ('msg_id', 'parent', 'children')
+
+    def __init__(self, msg_id):
+        # type: (str) -> None
+        self.msg_id = msg_id  # type: str
+        self.parent = None  # type: t.Optional[_ThreadNode]
+        self.children = []  # type: t.List[_ThreadNode]
+
+    def set_parent(self, parent):
+        # type: (t.Optional[_ThreadNode]) -> bool
+        """Move this node under parent, or detach it if parent is None
+
+        Returns:
+            bool: False if the link would create a loop, the tree is left unchanged
+        """
+        ancestor = parent
+        while ancestor is not None:
+            if ancestor is self:
+                return False
+            ancestor = ancestor.parent
+        if self.parent is not None:
+            self.parent.children = [c for c in self.parent.children if c is not self]
+        self.parent = parent
+        if parent is not None:
+            parent.children.append(self)
+        return True
+
+    def depth(self):
+        # type: () -> int
+        """Get the number of ancestors of this node
+        """
+        depth = 0
+        node = self.parent
+        while node is not None:
+            depth += 1
+            node = node.parent
+        return depth
+
+
 def references_algorithm(start_msg):
     # type: (Message) -> t.List[Message]
-    from anytree import Node, LoopError, PreOrderIter
 
     # find references
     #    # first try message ids in the references header line
     #    # if that fails use the first valid messageid in the in-reply-to header line as the only valid parent
     #    # if the reply to doesn't work then there are no references
     references = start_msg.references or start_msg.in_reply_to[:1]
+    start_msg_id = start_msg._message_id
 
     # determine if a message is a reply or a forward
     #    #  A message is considered to be a reply or forward if the base
@@ -175,47 +231,48 @@ def references_algorithm(start_msg):
     # TODO not sure how to check valid message ids
 
     # nodes which don't have parents
-    orphan_nodes = set()  # type: t.Set[Node]
+    orphan_nodes = set()  # type: t.Set[_ThreadNode]
     current = None
     # Map of msg ids to Nodes
-    node_map = {}  # type: t.Dict[str, Node]
+    node_map = {}  # type: t.Dict[str, _ThreadNode]
     for msg_id in references:
-        node = node_map.get(msg_id, Node(msg_id))
+        node = node_map.get(msg_id) or _ThreadNode(msg_id)
         node_map[msg_id] = node
         # if we are in a child and the child does not already have a parent
         # try to add the node
         if current is not None and node.parent is None:
-            try:
-                node.parent = current
-            except LoopError:
+            if not node.set_parent(current):
                 current = None
         # otherwise the node is a new orphan
         if current is None:
             current = node
-            orphan_nodes.append(current)
+            orphan_nodes.add(current)
+
+    # the sent dates of the referenced messages in the folder, loaded with one query
+    # only the dates are needed for sorting so no Message objects are built
+    from schema.youps import MessageSchema
+    date_map = dict(MessageSchema.objects.filter(
+        folder=start_msg._schema.folder, imap_account=start_msg._imap_account, base_message__message_id__in=references
+    ).values_list('base_message__message_id', 'base_message__date'))  # type: t.Dict[str, datetime]
+    date_map[start_msg_id] = start_msg.date
 
     # nodes which are not in our database
-    msg_map = {node_map[msg_id]: message_from_message_id(
-        msg_id, start_msg._imap_account, start_msg.folder, start_msg._imap_client) for msg_id in references}  # t.Dict[Node, t.Optional[Message]]
-    dummy_nodes = {node for node, msg in msg_map.iteritems()
-                   if msg is None}  # t.Set[Node]
+    dummy_nodes = {node_map[msg_id] for msg_id in references
+                   if msg_id not in date_map}  # t.Set[_ThreadNode]
 
     # PART 1 B
     # create a parent child link between the last reference and the current message.
     # if the current message already has a parent break the current parent child link unless this would create a loop
-    node = node_map.get(start_msg._message_id, Node(
-        start_msg._message_id))  # type: Node
-    node_map[start_msg._message_id] = node
-    try:
-        node.parent = current
-    except LoopError:
-        pass
+    node = node_map.get(start_msg_id) or _ThreadNode(
+        start_msg_id)  # type: _ThreadNode
+    node_map[start_msg_id] = node
+    node.set_parent(current)
 
     # PART 2
     # make any messages without parents children of a dummy root
-    root = Node('root')  # type: Node
+    root = _ThreadNode('root')  # type: _ThreadNode
     for orphan in orphan_nodes:
-        orphan.parent = root
+        orphan.set_parent(root)
 
     # PART 3
     # prune dummy messages from the tree
@@ -228,31 +285,43 @@ def references_algorithm(start_msg):
     #    # Do not promote the children if doing so would make them
     #    # children of the root, unless there is only one child.
     #    #
-    for node in list(PreOrderIter(root)):
-        if node not in dummy_nodes:
-            continue
-        dummy_node = node
+    # only the dummies need visiting, shallowest first so a dummy is handled
+    # before the dummies below it, as a pre order walk of the tree would
+    for dummy_node in sorted(dummy_nodes, key=lambda n: n.depth()):
         # if there are no children
         if not dummy_node.children:
-            dummy_node.parent = None
+            dummy_node.set_parent(None)
         # promote children but only promote at most one child to the root
-        elif dummy_node.parent != root or len(dummy_node.children) == 1:
-            for child in dummy_node.children:
-                child.parent = dummy_node.parent
+        elif dummy_node.parent is not root or len(dummy_node.children) == 1:
+            for child in list(dummy_node.children):
+                child.set_parent(dummy_node.parent)
+            # the dummy itself is deleted once its children are spliced in
+            dummy_node.set_parent(None)
 
     # PART 4
     # Sort the messages under the root (top-level siblings only)
     # by sent date as described in section 2.2.  In the case of a
     # dummy message, sort its children by sent date and then use
     # the first child for the top-level sort.
+    # the earliest sent date below each remaining dummy, so the key is a lookup
+    earliest = {}  # type: t.Dict[_ThreadNode, datetime]
+
     def sortkey(node):
-        if node not in dummy_nodes:
-            return msg_map[node].date
-        node.children = sorted(node.children, key=sortkey)
-        # assumes we have no dummies in the middle of the tree
-        return min(msg_map[n].date for n in node.children)
+        # type: (_ThreadNode) -> datetime
+        if node in dummy_nodes:
+            return earliest[node]
+        return date_map[node.msg_id]
+
+    # deepest first so a dummy's dummy children already have their dates
+    for dummy_node in sorted(dummy_nodes, key=lambda n: n.depth(), reverse=True):
+        # pruning the dummies below a dummy can leave it without children
+        if not dummy_node.children:
+            dummy_node.set_parent(None)
+            continue
+        dummy_node.children.sort(key=sortkey)
+        earliest[dummy_node] = sortkey(dummy_node.children[0])
 
-    root.children = sorted(root.children, key=sortkey)
+    root.children.sort(key=sortkey)
     assert isinstance(root.children, list)
 
     # TODO PART 5 and PART 6 RFC 5256
@@ -275,4 +344,7 @@ encoded_word_string_regex = re.compile(r'(=\?[^?]*?\?[qQbB]\?.*?\?=)', re.VERBOS
 header_comment_regex = re.compile(r'\((?:(?:[\ \t]*\r\n){0,1}[\ \t]*[\x01-\x08\x0B\x0C\x0E-\x1F\x21-\x27\x2A-\x5B\x5D-\x7F]|\\[\x01-\x09\x0B\x0C\x0E-\x7F])*(?:[\ \t]*\r\n){0,1}[\ \t]*\)')
 
 
-message_id_split_regex = re.compile(r'<(.*?)>')
\ No newline at end of file
+# Match the text between angle brackets in a message id header, i.e. <id@host>
+# negated classes instead of a lazy .*? so matching never has to backtrack.
+# the id must contain an @ and no quotes, angle brackets or newlines
+message_id_split_regex = re.compile(r'<([^<>"\n]*@[^<>"\n]*)>')
\ No newline at end of file
@@ -203,7 +203,8 @@ def loop_sync_user_inbox():
 
                 if res is not None and res.get('imap_log', ''):
                     log_decoded = json.loads(imapAccount.execution_log) if len(imapAccount.execution_log) else {}
-                    log_decoded.update( res['imap_log'] )
+                    # the execution log is keyed by timestamp
+                    log_decoded.update((entry["timestamp"], entry) for entry in res['imap_log'])
 
                     imapAccount.execution_log = json.dumps(log_decoded)
                     # imapAccount.execution_log = "%s\n%s" % (